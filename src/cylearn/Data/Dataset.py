@@ -1,5 +1,7 @@
+import functools
 import math
 import random
+from collections import OrderedDict
 from copy import deepcopy
 
 
@@ -16,10 +18,21 @@ class Dataset:
     But note that `data` does not keep up to date if `lazy_map()` was
     performed only.
 
+    A list passed to the constructor is stored as is, so the ownership
+    of it is handed over to the Dataset instance and it should not be
+    modified afterward. Use `from_copy()` if a defensive copy is needed.
+
+    If every element is a tuple of numbers or numpy arrays with the same
+    shapes, passing `columnar=True` stores each position of the tuples
+    as a single numpy array. This saves memory and lets a batch be
+    gathered with one indexing per array instead of one per element.
+
     Methods
     -------
+    from_copy(data)
     get(key)
     copy()
+    enable_memo(size)
     map(func)
     lazy_map(func)
     reduce(func)
@@ -31,13 +44,23 @@ class Dataset:
 
     '''
 
-    def __init__(self, data):
+    def __init__(self, data, *, copy_on_read=False, columnar=False):
         '''
         Constructor.
 
         Parameters
         ----------
         data : list-like
+        copy_on_read : bool, default=False
+            Keyword only.
+            If True, `get()` returns a deep copy of the stored item
+            instead of the item itself.
+        columnar : bool, default=False
+            Keyword only.
+            If True and `data` is homogeneous numeric, `data` is stored
+            as numpy arrays, one per position of the elements. Elements
+            are then read back as tuples of numpy values. Otherwise
+            `data` is stored as a list.
 
         Returns
         -------
@@ -47,30 +70,89 @@ class Dataset:
         ------
         TypeError
             `data` is not a list-like object.
+            `copy_on_read` is not a bool.
+            `columnar` is not a bool.
+        ValueError
+            `columnar` is True but 'numpy' is not installed.
+        '''
+        if not isinstance(copy_on_read, bool):
+            raise TypeError('type of `copy_on_read` must be bool')
+        if not isinstance(columnar, bool):
+            raise TypeError('type of `columnar` must be bool')
+
+        if not isinstance(data, list):
+            try:
+                data = list(data)
+            except TypeError:
+                raise TypeError('`data` must be a list-like object')
+
+        if columnar:
+            data = _Columns.from_list(data) or data
+
+        self._data = data
+        self._mappers = []
+        self._mapper = None
+        self._copy_on_read = copy_on_read
+        self._memo_size = 0
+        self._memo_cache = OrderedDict()
+
+    @classmethod
+    def from_copy(cls, data, *, copy_on_read=False, columnar=False):
+        '''
+        Construct a Dataset instance from a deep copy of `data`.
+
+        Parameters
+        ----------
+        data : list-like
+        copy_on_read : bool, default=False
+            Keyword only.
+            Check the docstring of `Dataset.__init__()`.
+        columnar : bool, default=False
+            Keyword only.
+            Check the docstring of `Dataset.__init__()`.
+
+        Returns
+        -------
+        dataset : Dataset
+
+        Raises
+        ------
+        TypeError
+            `data` is not a list-like object.
+            `copy_on_read` is not a bool.
+            `columnar` is not a bool.
+        ValueError
+            `columnar` is True but 'numpy' is not installed.
+
         '''
         try:
             data = list(data)
         except TypeError:
             raise TypeError('`data` must be a list-like object')
 
-        self._data = deepcopy(data)
-        self._mapper = None
+        return cls(deepcopy(data), copy_on_read=copy_on_read,
+                   columnar=columnar)
 
     def __len__(self):
         return len(self._data)
 
     def __getitem__(self, key):
-        if not isinstance(key, (int, slice)):
-            try:
-                key = int(key)
-            except TypeError:
-                raise TypeError('`key` must be int or slice')
-
+        # invalid keys are rejected by `data` itself
         if self._mapper is None:
             return self.get(key)
 
         if isinstance(key, slice):
             return [self._mapper(val) for val in self.get(key)]
+        elif self._memo_size:
+            # normalize negative keys and reject out of range ones
+            key = range(len(self))[key]
+            memo = self._memo_cache
+            if key in memo:
+                memo.move_to_end(key)
+                return memo[key]
+            val = self._mapper(self.get(key))
+            self._memoize(key, val)
+            return val
         else:
             return self._mapper(self.get(key))
 
@@ -85,7 +167,8 @@ class Dataset:
         Returns
         -------
         object
-            An object stored in `data`.
+            An object stored in `data`. It is a deep copy only if
+            `copy_on_read` was set to True.
 
         Raises
         ------
@@ -93,13 +176,66 @@ class Dataset:
             `i` is not an integer or a slice object.
 
         '''
-        if not isinstance(key, (int, slice)):
-            raise TypeError('`key` must be int or slice')
-
-        return deepcopy(self._data[key])
+        if self._copy_on_read:
+            return deepcopy(self._data[key])
+        return self._data[key]
 
     def copy(self):
-        return deepcopy(self)
+        '''
+        Make a shallow copy.
+
+        The copy shares `data` with the original instance, which is safe
+        since neither of them modifies it in place. Only the list of
+        functions composing `mapper` is copied.
+
+        Returns
+        -------
+        dataset : Dataset
+
+        '''
+        dataset = object.__new__(type(self))
+        dataset.__dict__.update(self.__dict__)
+        dataset._mappers = list(self._mappers)
+        dataset._memo_cache = OrderedDict()
+        return dataset
+
+    def enable_memo(self, size):
+        '''
+        Memoize the results of `mapper` for recently accessed elements.
+
+        Once an element is mapped, its result is kept and returned as is
+        on later accesses until it becomes one of the least recently
+        used when more than `size` results are kept. This only matters
+        if `lazy_map()` was called, and helps when an expensive `mapper`
+        is applied to the same elements repeatedly, e.g. across epochs
+        with caching of `Loader` disabled.
+
+        Parameters
+        ----------
+        size : int
+            The maximum number of kept results. `size` should be greater
+            than or equal to 0, and 0 disables memoization.
+
+        Returns
+        -------
+        dataset : Dataset
+
+        Raises
+        ------
+        TypeError
+            `size` is not an integer.
+        ValueError
+            `size` is less than 0.
+
+        '''
+        if not isinstance(size, int):
+            raise TypeError('type of `size` must be int')
+        if size < 0:
+            raise ValueError('`size` must be greater than or equal to 0')
+
+        dataset = self.copy()
+        dataset._memo_size = size
+        return dataset
 
     def map(self, func):
         '''
@@ -134,8 +270,13 @@ class Dataset:
 
         dataset = self.copy()
         dataset._update_mapper(func)
-        dataset._data = dataset[:]
-        dataset._mapper = None
+
+        # map straight from `data` in a single pass
+        data = self._data
+        if self._copy_on_read:
+            data = deepcopy(data)
+        dataset._data = list(map(dataset._mapper, data))
+        dataset._set_mappers([])
         return dataset
 
     def lazy_map(self, func):
@@ -184,7 +325,7 @@ class Dataset:
         dataset._update_mapper(func)
         return dataset
 
-    def reduce(self, func):
+    def reduce(self, func, *, engine='python'):
         '''
         Reduce all elements into one by the given function.
 
@@ -192,6 +333,19 @@ class Dataset:
         ----------
         func : callable
             `func` should take two arguments and return a value.
+        engine : {'python', 'numba'}, default='python'
+            Keyword only.
+            If 'numba', `func` and the reducing loop are compiled by
+            'numba' and run over the elements as a numpy array. This
+            only works for numeric elements. Tuple elements are stacked
+            into rows of a single array, so `func` receives and returns
+            rows instead of tuples, and their positions must share the
+            same shape and dtype. `func` should be a Python
+            function that 'numba' can compile or a function already
+            decorated by `numba.njit`. Builtins such as `operator.add`
+            are not accepted. The compiled loops of the 32 most recently
+            used `func` are kept, so pass the same function object, not
+            a new lambda on every call, to reuse the compiled loop.
 
         Returns
         -------
@@ -203,17 +357,36 @@ class Dataset:
         ------
         TypeError
             `func` is not a callable.
+            `engine` is not a str.
+            `engine` is 'numba' but 'numba' cannot compile `func`.
+        ValueError
+            `engine` is neither 'python' nor 'numba'.
+            `engine` is 'numba' but 'numba' is not installed.
+            `engine` is 'numba' but tuple elements have positions of
+            different shapes or dtypes.
 
         Notes
         -----
         When `data` has only one element, `reduce()` will just return
-        its copy even `func` does not fit the requirement.
+        it even `func` does not fit the requirement. The returned element
+        is a copy only if `copy_on_read` was set to True or `mapper`
+        produces a new object.
 
         '''
         if not callable(func):
             raise TypeError('`func` must be a callable')
-
-        val = deepcopy(self[0])
+        if not isinstance(engine, str):
+            raise TypeError('type of `engine` must be str')
+        if engine not in ('python', 'numba'):
+            raise ValueError('`engine` must be \'python\' or \'numba\'')
+
+        if engine == 'numba':
+            # columnar data is handed over as arrays without reading items
+            if isinstance(self._data, _Columns) and self._mapper is None:
+                return _numba_reduce(func, self._data)
+            return _numba_reduce(func, self[:])
+
+        val = self[0]
         for i in range(1, len(self)):
             val = func(val, self[i])
         return val
@@ -247,19 +420,240 @@ class Dataset:
         if not callable(func):
             raise TypeError('`func` must be a callable')
 
-        data = list()
-        for i in range(len(self)):
-            val = self[i]
-            if func(val):
-                data.append(deepcopy(val))
-        return type(self)(data)
+        dataset = type(self)([], copy_on_read=self._copy_on_read)
+        dataset._memo_size = self._memo_size
+
+        # columnar data keeps its layout by taking the kept positions
+        if isinstance(self._data, _Columns) and self._mapper is None:
+            kept = [i for i in range(len(self)) if func(self.get(i))]
+            dataset._data = _take(self._data, kept)
+            return dataset
+
+        # map and filter in a single pass over `data`
+        data = self._data
+        if self._copy_on_read:
+            data = deepcopy(data)
+        if self._mapper is not None:
+            data = map(self._mapper, data)
+        dataset._data = list(filter(func, data))
+        return dataset
+
+    def _get_batch(self, indices, pool=None, chunksize=None):
+        if self._memo_size and self._mapper is not None:
+            return self._get_batch_with_memo(indices, pool, chunksize)
+        else:
+            return self._get_batch_without_memo(indices, pool, chunksize)
+
+    def _get_batch_without_memo(self, indices, pool, chunksize):
+        # fetch all items at once and map them in a single submission
+        if isinstance(self._data, _Columns):
+            data = self._data.items(indices)
+        elif isinstance(indices, slice):
+            data = self._data[indices]
+        else:
+            data = [self._data[i] for i in indices]
+
+        if self._copy_on_read:
+            data = deepcopy(data)
 
-    def _update_mapper(self, func):
         if self._mapper is None:
-            self._mapper = func
+            return data
+        if pool is None:
+            return list(map(self._mapper, data))
+
+        # workers pick up small chunks as they finish, so one slow item
+        # does not hold the others idle; indices restore the order
+        result = [None] * len(data)
+        for i, val in pool.imap_unordered(
+                _IndexedMapper(self._mapper), enumerate(data), chunksize):
+            result[i] = val
+        return result
+
+    def _get_batch_with_memo(self, indices, pool, chunksize):
+        if isinstance(indices, slice):
+            indices = range(*indices.indices(len(self)))
+
+        memo = self._memo_cache
+        batch = dict()
+        for i in indices:
+            if i in memo:
+                memo.move_to_end(i)
+                batch[i] = memo[i]
+
+        missing = [i for i in indices if i not in batch]
+        if missing:
+            data = self._get_batch_without_memo(missing, pool, chunksize)
+            for i, val in zip(missing, data):
+                batch[i] = val
+                self._memoize(i, val)
+        return [batch[i] for i in indices]
+
+    def _memoize(self, key, val):
+        memo = self._memo_cache
+        memo[key] = val
+        memo.move_to_end(key)
+        if len(memo) > self._memo_size:
+            memo.popitem(last=False)
+
+    def _update_mapper(self, func):
+        self._set_mappers(self._mappers + [func])
+
+    def _set_mappers(self, funcs):
+        # `mapper` is rebuilt from `funcs` so that accessing an element
+        # costs a single call no matter how many functions are chained
+        self._mappers = list(funcs)
+        self._memo_cache = OrderedDict()
+        if not self._mappers:
+            self._mapper = None
+        elif len(self._mappers) == 1:
+            self._mapper = self._mappers[0]
         else:
-            def wrapper(x, mapper=self._mapper): return func(mapper(x))
-            self._mapper = wrapper
+            def mapper(x, funcs=tuple(self._mappers)):
+                for func in funcs:
+                    x = func(x)
+                return x
+            self._mapper = mapper
+
+
+class _Columns:
+    '''
+    A read-only list-like storage keeping homogeneous numeric elements
+    as one numpy array per position.
+    '''
+
+    def __init__(self, columns, packed):
+        # `packed` tells whether an element is a tuple of the columns or
+        # the value of the only column
+        self.columns = columns
+        self.packed = packed
+
+    @classmethod
+    def from_list(cls, data):
+        try:
+            import numpy as np
+        except ModuleNotFoundError as e:
+            raise ValueError(
+                '`columnar` can only be False if \'numpy\' is not '
+                'installed. Type `pip install numpy` in the command prompt '
+                'to fix this issue.'
+            ) from e
+
+        if not data:
+            return None
+
+        packed = isinstance(data[0], tuple)
+        width = len(data[0]) if packed else 1
+        if packed and any(not isinstance(d, tuple) or len(d) != width
+                          for d in data):
+            return None
+
+        columns = list()
+        for k in range(width):
+            try:
+                column = np.stack(
+                    [np.asarray(d[k] if packed else d) for d in data])
+            except ValueError:
+                return None
+            if column.dtype.kind not in 'biufc':
+                return None
+            columns.append(column)
+        return cls(columns, packed)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if hasattr(key, '__index__'):
+            if self.packed:
+                return tuple(column[key] for column in self.columns)
+            return self.columns[0][key]
+        if not isinstance(key, slice):
+            raise TypeError('`key` must be int or slice')
+        return self.items(key)
+
+    def items(self, key):
+        columns = self.gather(key)
+        if self.packed:
+            return list(zip(*columns))
+        return list(columns[0])
+
+    def gather(self, key):
+        # one indexing per column gathers a whole slice or batch
+        if not isinstance(key, slice):
+            key = list(key)
+        return [column[key] for column in self.columns]
+
+    def take(self, key):
+        if not isinstance(key, slice):
+            key = list(key)
+        return type(self)([column[key] for column in self.columns],
+                          self.packed)
+
+
+def _numba_reduce(func, data):
+    try:
+        import numba
+        import numpy as np
+    except ModuleNotFoundError as e:
+        raise ValueError(
+            '`engine` can only be \'python\' if \'numba\' is not '
+            'installed. Type `pip install numba` in the command prompt '
+            'to fix this issue.'
+        ) from e
+
+    if not isinstance(data, _Columns):
+        arr = np.asarray(data)
+    elif data.packed:
+        first = data.columns[0]
+        if any(column.shape != first.shape or column.dtype != first.dtype
+               for column in data.columns):
+            raise ValueError(
+                'positions of tuple elements must have the same shape and '
+                'dtype when `engine` is \'numba\''
+            )
+        arr = np.stack(data.columns, axis=1)
+    else:
+        arr = data.columns[0]
+
+    reducer = _compile_numba_reducer(func)
+    try:
+        return reducer(arr)
+    except numba.core.errors.TypingError as e:
+        raise TypeError('\'numba\' cannot compile `func`') from e
+
+
+# a compiled reducer holds `func`, so the number of kept ones is bounded
+@functools.lru_cache(maxsize=32)
+def _compile_numba_reducer(func):
+    import numba
+
+    # reuse `func` if it has been decorated by `numba.njit` already
+    try:
+        jitted = func if hasattr(func, 'py_func') else numba.njit(func)
+    except TypeError as e:
+        raise TypeError('\'numba\' cannot compile `func`') from e
+
+    @numba.njit
+    def reducer(arr):
+        acc = arr[0]
+        for i in range(1, arr.shape[0]):
+            acc = jitted(acc, arr[i])
+        return acc
+
+    return reducer
+
+
+class _IndexedMapper:
+    def __init__(self, mapper):
+        self.mapper = mapper
+
+    def __call__(self, item):
+        i, val = item
+        return i, self.mapper(val)
 
 
 def shuffle(dataset1, dataset2=None, seed=None):
@@ -272,8 +666,8 @@ def shuffle(dataset1, dataset2=None, seed=None):
     dataset2 : Dataset, optional
         `dataset2` will be shuffled in unison with `dataset1`.
     seed : int, optional
-        A number for setting the Python built-in random number
-        generator.
+        A number for seeding a Python built-in random number generator
+        dedicated to this call.
 
     Returns
     -------
@@ -298,28 +692,20 @@ def shuffle(dataset1, dataset2=None, seed=None):
         raise TypeError('type of `dataset2` must be Dataset')
     if not isinstance(seed, (int, type(None))):
         raise TypeError('type of `seed` must be int')
-    else:
-        random.seed(seed)
-
-    dataset1 = dataset1.copy()
-    if isinstance(dataset2, Dataset):
-        dataset2 = dataset2.copy()
 
     if dataset2 is not None:
         assert len(dataset1) == len(dataset2), \
             'inconsistent length between `dataset1` and `dataset2`'
 
-        for i in range(len(dataset1) - 1, 0, -1):
-            j = random.randint(0, i)
-            dataset1._data[i], dataset1._data[j] = \
-                dataset1._data[j], dataset1._data[i]
-            dataset2._data[i], dataset2._data[j] = \
-                dataset2._data[j], dataset2._data[i]
-    else:
-        for i in range(len(dataset1) - 1, 0, -1):
-            j = random.randint(0, i)
-            dataset1._data[i], dataset1._data[j] = \
-                dataset1._data[j], dataset1._data[i]
+    # one permutation is shared to shuffle both datasets in unison
+    perm = list(range(len(dataset1)))
+    random.Random(seed).shuffle(perm)
+
+    dataset1 = dataset1.copy()
+    dataset1._data = _take(dataset1._data, perm)
+    if dataset2 is not None:
+        dataset2 = dataset2.copy()
+        dataset2._data = _take(dataset2._data, perm)
 
     if dataset2 is None:
         return dataset1
@@ -367,8 +753,19 @@ def split(dataset, ratio):
         mid = ratio
     elif isinstance(ratio, float):
         mid = math.ceil(ratio * len(dataset))
-    dataset1 = type(dataset)(dataset._data[:mid])
-    dataset2 = type(dataset)(dataset._data[mid:])
-    dataset1._mapper = dataset._mapper
-    dataset2._mapper = dataset._mapper
+    dataset1 = type(dataset)([], copy_on_read=dataset._copy_on_read)
+    dataset2 = type(dataset)([], copy_on_read=dataset._copy_on_read)
+    dataset1._data = _take(dataset._data, slice(None, mid))
+    dataset2._data = _take(dataset._data, slice(mid, None))
+    dataset1._set_mappers(dataset._mappers)
+    dataset2._set_mappers(dataset._mappers)
+    dataset1._memo_size = dataset2._memo_size = dataset._memo_size
     return dataset1, dataset2
+
+
+def _take(data, indices):
+    if isinstance(data, _Columns):
+        return data.take(indices)
+    if isinstance(indices, slice):
+        return data[indices]
+    return [data[i] for i in indices]
@@ -1,6 +1,17 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from itertools import islice
 import random
-from .Dataset import Dataset
+from .Dataset import Dataset, _Columns
+
+
+def _check_types(args):
+    for name, (value, expected) in args.items():
+        if not isinstance(value, expected):
+            raise TypeError(
+                'type of `{}` must be {}'.format(name, expected.__name__)
+            )
 
 
 class _Cache:
@@ -8,29 +19,31 @@ class _Cache:
         if not isinstance(size, int):
             raise TypeError('`size` must be int')
 
-        self.cache = [None for x in range(size)]
+        # `cache` only holds stored items, `present` marks which are stored
+        self.cache = dict()
+        self.present = bytearray(size)
         self.count = 0
 
     def __len__(self):
-        return len(self.cache)
+        return len(self.present)
 
     def __getitem__(self, key):
         if not isinstance(key, (int, slice)):
             raise TypeError('`key` must be int or slice')
-        return self.cache[key]
 
-    def __setitem__(self, key, value):
-        if not isinstance(key, (int, slice)):
-            raise TypeError('`key` must be int or slice')
+        if isinstance(key, slice):
+            return [self.cache.get(i) for i in range(*key.indices(len(self)))]
+        return self.cache.get(key)
 
+    def __setitem__(self, key, value):
         if isinstance(key, slice):
-            for data in self[key]:
-                if data is None:
-                    self.count += 1
+            for i, val in zip(range(*key.indices(len(self))), value):
+                self[i] = val
         else:
-            self.count += 1
-
-        self.cache[key] = value
+            if not self.present[key]:
+                self.present[key] = 1
+                self.count += 1
+            self.cache[key] = value
 
     def is_full(self):
         return self.count == len(self)
@@ -80,12 +93,15 @@ class Loader:
     drop_last : bool
     prefetch : int
     parallel : int
+    persistent : bool
+    return_type : str
 
     '''
 
     def __init__(self, dataset, batch_size, *,
                  shuffle=True, drop_last=False, prefetch=0,
-                 parallel=1, enable_cache=False):
+                 parallel=1, persistent=False, enable_cache=False,
+                 cache_copy=False, return_type='list'):
         '''
         Constructor.
 
@@ -101,15 +117,34 @@ class Loader:
             less than `batch_size`.
         prefetch : int, default=0
             Keyword only.
-            Indicating how many batches to be prefetched. `prefetch`
-            should be greater than or equal to 0.
+            Indicating how many batches to be prefetched in a background
+            thread. `prefetch` should be greater than or equal to 0.
         parallel : int, default=1
             Keyword only.
             The number of workers. `parallel` should be greater than or
             equal to 1.
+        persistent : bool, default=False
+            Keyword only.
+            If True, workers are kept alive across iterations instead of
+            being created at the start of every iteration and shut down
+            at its end. Call `close()` or use the instance as a context
+            manager to shut them down when the instance is no longer
+            needed.
         enable_cache : bool, default=False
             Keyword only.
             Use with caution, out of memory may happen.
+        cache_copy : bool, default=False
+            Keyword only.
+            If True, a deep copy of each loaded item is stored in the
+            cache instead of the item itself.
+        return_type : {'list', 'ndarray', 'torch'}, default='list'
+            Keyword only.
+            The type of yielded batches. If 'ndarray' or 'torch', items
+            of a batch are stacked into a numpy array or a torch tensor.
+            Tuple items are stacked position by position into a tuple of
+            arrays or tensors. A Dataset constructed with `columnar=True`
+            and no `lazy_map()` is batched without going through its
+            items at all.
 
         Returns
         -------
@@ -124,32 +159,57 @@ class Loader:
             `drop_last` is not a bool.
             `prefetch` is not an integer.
             `parallel` is not an integer.
+            `persistent` is not a bool.
             `enable_cache` is not a bool.
+            `cache_copy` is not a bool.
+            `return_type` is not a str.
         ValueError
+            `batch_size` is less than 1.
             `parallel` is less than 1.
             `prefetch` is less than 0.
             `parallel` is greater than 1 but 'multiprocess' is not
             installed.
+            `return_type` is not one of 'list', 'ndarray', and 'torch'.
+            `return_type` needs 'numpy' or 'torch' which is not
+            installed.
 
         '''
-        if not isinstance(dataset, Dataset):
-            raise TypeError('type of `dataset` must be Dataset')
-        if not isinstance(batch_size, int):
-            raise TypeError('type of `batch_size` must be int')
-        if not isinstance(shuffle, bool):
-            raise TypeError('type of `shuffle` must be bool')
-        if not isinstance(drop_last, bool):
-            raise TypeError('type of `drop_last` must be bool')
-        if not isinstance(prefetch, int):
-            raise TypeError('type of `prefetch` must be int')
-        if not isinstance(parallel, int):
-            raise TypeError('type of `parallel` must be int')
-        if not isinstance(enable_cache, bool):
-            raise TypeError('type of `enable_cache` must be bool')
+        _check_types({
+            'dataset': (dataset, Dataset),
+            'batch_size': (batch_size, int),
+            'shuffle': (shuffle, bool),
+            'drop_last': (drop_last, bool),
+            'prefetch': (prefetch, int),
+            'parallel': (parallel, int),
+            'persistent': (persistent, bool),
+            'enable_cache': (enable_cache, bool),
+            'cache_copy': (cache_copy, bool),
+            'return_type': (return_type, str),
+        })
+        if batch_size < 1:
+            raise ValueError('`batch_size` must be greater than or equal to 1')
         if parallel < 1:
             raise ValueError('`parallel` must be greater than or equal to 1')
         if prefetch < 0:
             raise ValueError('`prefetch` must be greater than or equal to 0')
+        if return_type not in ('list', 'ndarray', 'torch'):
+            raise ValueError(
+                '`return_type` must be \'list\', \'ndarray\' or \'torch\''
+            )
+        self._np = self._torch = None
+        if return_type != 'list':
+            try:
+                import numpy
+                self._np = numpy
+                if return_type == 'torch':
+                    import torch
+                    self._torch = torch
+            except ModuleNotFoundError as e:
+                raise ValueError(
+                    '`return_type` can only be \'list\' if \'{0}\' is not '
+                    'installed. Type `pip install {0}` in the command prompt '
+                    'to fix this issue.'.format(e.name)
+                ) from e
         if parallel > 1:
             try:
                 import multiprocess
@@ -159,103 +219,184 @@ class Loader:
                     'installed. Type `pip install multiprocess` in the '
                     'command prompt to fix this issue.'
                 ) from e
-            else:
-                # expose multiprocess to the global symbol table
-                globals()['multiprocess'] = locals()['multiprocess']
+            self._mp = multiprocess
+        else:
+            self._mp = None
 
         self.dataset = dataset
         self.batch_size = batch_size
+        self._n = len(dataset)
         self.shuffle = shuffle
         self.drop_last = drop_last
         self.prefetch = prefetch
+        self.persistent = persistent
+        self.return_type = return_type
 
         # no need to create workers when all data is in memory
         self.parallel = parallel if self.dataset._mapper is not None else 1
 
         # no need to use cache when all data is in memory
-        self._cache = _Cache(len(dataset)) \
+        self._cache = _Cache(self._n) \
             if enable_cache and self.dataset._mapper is not None else None
 
+        self._cache_copy = cache_copy
+
+        # columnar data can be batched by indexing the columns directly
+        self._columns = dataset._data \
+            if (return_type != 'list'
+                and isinstance(dataset._data, _Columns)
+                and dataset._mapper is None) else None
+
+        self._pool = None
         self._seed = None
 
+        # `dataset` is immutable, so the number of batches never changes
+        self._num_batches = self._n // batch_size
+        if not drop_last and self._n % batch_size:
+            self._num_batches += 1
+
     def __len__(self):
-        num_batch = len(self.dataset) // self.batch_size
-        if not self.drop_last and len(self.dataset) % self.batch_size:
-            num_batch += 1
-        return num_batch
+        return self._num_batches
 
     def __iter__(self):
-        if self.parallel > 1:
-            self._pool = multiprocess.Pool(self.parallel)
-        else:
+        # no need to create workers once all data is in the cache
+        if (self.parallel > 1
+            and self._pool is None
+                and (self._cache is None or not self._cache.is_full())):
+            self._pool = self._mp.Pool(self.parallel)
+
+        try:
+            yield from self._iter_batches()
+        finally:
+            if (not self.persistent
+                    or (self._cache is not None and self._cache.is_full())):
+                self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Shut down the workers if there are any.
+
+        This is only needed if `persistent` was set to True. The instance
+        can still be iterated afterward, and new workers will be created
+        when needed.
+
+        Returns
+        -------
+        None
+
+        '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
             self._pool = None
 
-        indices = list(range(len(self.dataset)))
+    def _iter_batches(self):
         if self.shuffle:
+            indices = list(range(self._n))
             if self._seed is not None:
-                random.seed(self._seed())
-            for i in range(len(self.dataset) - 1, 0, -1):
-                j = random.randint(0, i)
-                indices[i], indices[j] = indices[j], indices[i]
-
-        batch_indices_iter = iter(self._batch_indices_helper(indices))
+                random.Random(self._seed()).shuffle(indices)
+            else:
+                random.shuffle(indices)
+            batch_indices_iter = (
+                indices[batch] for batch in self._batch_indices_helper()
+            )
+        else:
+            # batches are contiguous, so `data` can be sliced directly
+            batch_indices_iter = iter(self._batch_indices_helper())
         if self.prefetch:
-            while True:
-                prefetch_buffer = list()
-                try:
-                    for i in range(self.prefetch):
-                        prefetch_buffer.append(
-                            self._get_batch(next(batch_indices_iter))
-                        )
-                except StopIteration:
-                    break
-                finally:
-                    for batch in prefetch_buffer:
-                        yield batch
+            # a background thread keeps `prefetch` batches in flight while
+            # the consumer is working on the yielded one
+            executor = ThreadPoolExecutor(max_workers=1)
+            futures = deque()
+            try:
+                for batch_indices in islice(batch_indices_iter,
+                                            self.prefetch):
+                    futures.append(
+                        executor.submit(self._get_batch, batch_indices)
+                    )
+                for batch_indices in batch_indices_iter:
+                    futures.append(
+                        executor.submit(self._get_batch, batch_indices)
+                    )
+                    yield futures.popleft().result()
+                while futures:
+                    yield futures.popleft().result()
+            finally:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
         else:
-            while True:
-                try:
-                    yield self._get_batch(next(batch_indices_iter))
-                except StopIteration:
-                    break
-
-        if (self._pool is not None
-            and self._cache is not None
-                and self._cache.is_full()):
-            self._pool.close()
+            for batch_indices in batch_indices_iter:
+                yield self._get_batch(batch_indices)
 
-    def _batch_indices_helper(self, indices):
-        for i in range(0, len(indices), self.batch_size):
-            batch_indices = indices[i:i+self.batch_size]
-            if len(batch_indices) == self.batch_size or not self.drop_last:
-                yield batch_indices
+    def _batch_indices_helper(self):
+        stop = self._n
+        if self.drop_last:
+            stop -= stop % self.batch_size
+        for i in range(0, stop, self.batch_size):
+            yield slice(i, i+self.batch_size)
 
     def _get_batch(self, batch_indices):
+        if self._columns is not None:
+            return self._get_batch_from_columns(batch_indices)
+
         if self._cache is None:
-            return self._get_batch_without_cache(batch_indices)
+            batch = self._get_batch_without_cache(batch_indices)
         else:
-            return self._get_batch_with_cache(batch_indices)
+            batch = self._get_batch_with_cache(batch_indices)
 
-    def _get_batch_without_cache(self, batch_indices):
-        if self._pool is None:
-            return [self.dataset[i] for i in batch_indices]
+        if self.return_type == 'list':
+            return batch
+        elif batch and isinstance(batch[0], tuple):
+            return tuple(self._to_array(field) for field in zip(*batch))
         else:
-            data = [self.dataset.get(i) for i in batch_indices]
-            if self.dataset._mapper is None:
-                return data
-            else:
-                return self._pool.map(self.dataset._mapper, data)
+            return self._to_array(batch)
+
+    def _get_batch_from_columns(self, batch_indices):
+        columns = self._columns.gather(batch_indices)
+        # slicing gives views of the storage, which must not be yielded
+        if isinstance(batch_indices, slice):
+            columns = [column.copy() for column in columns]
+        if self._torch is not None:
+            columns = [self._torch.from_numpy(column) for column in columns]
+
+        if self._columns.packed:
+            return tuple(columns)
+        else:
+            return columns[0]
+
+    def _to_array(self, items):
+        array = self._np.stack(items)
+        if self._torch is not None:
+            return self._torch.from_numpy(array)
+        return array
+
+    def _get_batch_without_cache(self, batch_indices):
+        chunksize = max(1, self.batch_size // (self.parallel * 4))
+        return self.dataset._get_batch(batch_indices, self._pool, chunksize)
 
     def _get_batch_with_cache(self, batch_indices):
-        not_in_cache_indices = \
-            [i for i in batch_indices if self._cache[i] is None]
+        if isinstance(batch_indices, slice):
+            batch_indices = range(*batch_indices.indices(self._n))
+
+        present = self._cache.present
+        not_in_cache_indices = [i for i in batch_indices if not present[i]]
 
         if len(not_in_cache_indices):
             data = self._get_batch_without_cache(not_in_cache_indices)
+            if self._cache_copy:
+                data = deepcopy(data)
             for i, data in zip(not_in_cache_indices, data):
-                self._cache[i] = deepcopy(data)
+                self._cache[i] = data
 
-        return [self._cache[i] for i in batch_indices]
+        cache = self._cache.cache
+        return [cache[i] for i in batch_indices]
 
     def _set_seed(self, seed):
         self._seed = _Seed(seed)